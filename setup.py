@@ -6,7 +6,7 @@ setup(
     description="Tools for Synology NAS",
     author="aubustou",
     author_email="survivalfr@yahoo.fr",
-    install_requires=["requests", "pylast", "urllib3"],
+    install_requires=["aiohttp", "cachetools", "orjson", "pylast"],
     packages=["syno_tools"],
     entry_points={
         "console_scripts": [
@@ -0,0 +1,110 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import pickle
+import sqlite3
+import time
+from pathlib import Path
+from typing import Any, Literal, Optional, cast
+
+CACHE_DIR = Path("~/.cache/syno-tools").expanduser()
+SIMILAR_TTL = 7 * 86400
+ENDPOINT_TTL = 86400
+
+
+def get_cache_mode() -> Optional[Literal["ignore", "clear"]]:
+    """SYNO_CACHE=ignore skips cached entries, SYNO_CACHE=clear wipes them."""
+    mode = os.getenv("SYNO_CACHE")
+    if mode not in (None, "", "ignore", "clear"):
+        logging.warning("Unknown SYNO_CACHE value %r, ignoring it", mode)
+        return None
+    return cast(Optional[Literal["ignore", "clear"]], mode or None)
+
+
+class SimilarCache:
+    """Last.fm similar artists persisted in SQLite, so restarts do not hit the API."""
+
+    def __init__(self, path: Path = CACHE_DIR / "similar.db", ttl: int = SIMILAR_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.mode = get_cache_mode()
+        self._connection: Optional[sqlite3.Connection] = None
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._connection = sqlite3.connect(self.path)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache "
+                "(artist TEXT PRIMARY KEY, similar TEXT, fetched_at INTEGER)"
+            )
+            if self.mode == "clear":
+                logging.info("Clearing similar artists cache %s", self.path)
+                self._connection.execute("DELETE FROM cache")
+            self._connection.commit()
+        return self._connection
+
+    def get(self, artist: str) -> Optional[list[str]]:
+        if self.mode == "ignore":
+            return None
+
+        row = self.connection.execute(
+            "SELECT similar, fetched_at FROM cache WHERE artist=?", (artist,)
+        ).fetchone()
+        if row is None:
+            return None
+
+        similar, fetched_at = row
+        if time.time() - fetched_at >= self.ttl:
+            return None
+        return json.loads(similar)
+
+    def set(self, artist: str, similar: list[str]):
+        # Written even in "ignore" mode so that the fresh answer replaces the stale one
+        self.connection.execute(
+            "INSERT OR REPLACE INTO cache (artist, similar, fetched_at) VALUES (?, ?, ?)",
+            (artist, json.dumps(similar), int(time.time())),
+        )
+        self.connection.commit()
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+class EndpointCache:
+    """DSM API versions and remote player id, pickled per (hostname, player name)."""
+
+    def __init__(self, path: Path = CACHE_DIR / "endpoint.pkl", ttl: int = ENDPOINT_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.mode = get_cache_mode()
+
+    def _load(self) -> dict[tuple[str, str], dict[str, Any]]:
+        try:
+            with self.path.open("rb") as f:
+                return pickle.load(f)
+        except (OSError, EOFError, pickle.PickleError):
+            return {}
+
+    def get(self, key: tuple[str, str]) -> Optional[dict[str, Any]]:
+        if self.mode is not None:
+            return None
+
+        entry = self._load().get(key)
+        if entry is None or time.time() - entry["fetched_at"] >= self.ttl:
+            return None
+        return entry
+
+    def set(self, key: tuple[str, str], **values: Any):
+        # "clear" drops every other endpoint when writing this one
+        entries = {} if self.mode == "clear" else self._load()
+        entries[key] = {**values, "fetched_at": int(time.time())}
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.path.open("wb") as f:
+            pickle.dump(entries, f)
@@ -1,23 +1,53 @@
 from __future__ import annotations
 
-import copy
+import asyncio
+import functools
 import logging
 import os
+import pickle
 import time
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
 from pprint import pprint
-from typing import TypedDict, Literal, Any, Optional, cast
+from typing import TypedDict, Literal, Any, Callable, Optional, TypeVar, cast
+from urllib.parse import quote_plus
 
+import aiohttp
+import orjson
 import pylast
-import urllib3
-from requests import Session
+from cachetools import LRUCache, TTLCache
 
-urllib3.disable_warnings()
+from syno_tools.apicache import CACHE_DIR, EndpointCache, SimilarCache
+from syno_tools.ratelimit import TokenBucket
 
 REMOTE_PLAYER_NAME = "Salon (DLNA)"
 DSM_HOSTNAME = os.getenv("DSM_HOSTNAME")
+SEARCH_WORKERS = 6
+# SYNO.API error codes for a missing, timed out or invalid session
+SESSION_ERROR_CODES = {105, 106, 107, 119}
+COOKIES_PATH = CACHE_DIR / "cookies.pickle"
+FORM_HEADERS = {"Content-Type": "application/x-www-form-urlencoded"}
 
-SIMILAR_ARTISTS: dict[str, set[str]] = {}
+# Request bodies, encoded once
+LIST_PLAYERS_BODY = b"api=SYNO.AudioStation.RemotePlayer&version=3&method=list"
+PLAYER_STATUS_BODY = b"api=SYNO.AudioStation.RemotePlayerStatus&version=1&method=getstatus&id=%s&additional=song_tag"
+SEARCH_ARTIST_BODY = b"api=SYNO.AudioStation.Artist&version=4&method=list&filter=%s&library=all&limit=10&offset=0&additional=avg_rating"
+
+# Poll delays, in seconds
+IDLE_POLL_INTERVAL = 30
+MAX_POLL_INTERVAL = 60
+RECONNECT_DELAY = 15
+# Upper bound for a single DSM call, instead of aiohttp's five minutes
+REQUEST_TIMEOUT = 20
+RATE_LIMIT_DELAY = 60
+
+SIMILAR_ARTISTS = SimilarCache()
+ENDPOINTS = EndpointCache()
+
+# pylast is blocking, its calls get their own small pool off the event loop
+LASTFM_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix="pylast")
+
+T = TypeVar("T")
 
 
 class MandatorySynoVersion(TypedDict):
@@ -78,22 +108,49 @@ class NowPlaying(SongTag):
     title: str
 
 
+async def run_lastfm(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """Await a blocking pylast call run in LASTFM_EXECUTOR."""
+    return await asyncio.get_running_loop().run_in_executor(
+        LASTFM_EXECUTOR, functools.partial(func, *args, **kwargs)
+    )
+
+
+def is_rate_limited(error: pylast.WSError) -> bool:
+    return str(error.get_id()) == str(pylast.STATUS_RATE_LIMIT_EXCEEDED)
+
+
 def get_similar(
     network: pylast.LastFMNetwork, artist: str, limit: int = 30
 ) -> list[str]:
+    """Ask Last.fm, only letting pylast.WSError through when rate limited."""
     logging.info(f"Looking for similar artists to {artist}")
     try:
-        artist = network.get_artist(artist)
-        return [x.item.name for x in artist.get_similar(limit=limit)]
-    except pylast.WSError:
+        return [
+            x.item.name for x in network.get_artist(artist).get_similar(limit=limit)
+        ]
+    except pylast.WSError as e:
+        if is_rate_limited(e):
+            raise
         logging.info(f"Artist {artist} not found")
         return []
 
 
+def _tokens(name: str) -> frozenset[str]:
+    return frozenset(name.replace(",", " ").split())
+
+
+def _track_key(info: NowPlaying) -> tuple[str, str, str]:
+    return info["title"], info["artist"], info["album"]
+
+
 class RemotePlayerError(RuntimeError):
     pass
 
 
+class SessionError(RemotePlayerError):
+    """DSM rejected the session cookies, logging in again fixes it."""
+
+
 @dataclass
 class AudioStationRemote:
     hostname: str
@@ -106,130 +163,299 @@ class AudioStationRemote:
 
     version: int = field(default=1, init=False)
     endpoint: str = field(init=False)
+    base_url: str = field(init=False)
     player_id: str = field(init=False)
+    _players: dict[str, str] = field(default_factory=dict, init=False, repr=False)
+    _status_body: bytes = field(init=False, repr=False)
 
     versions: dict[str, SynoVersion] = field(default_factory=dict, init=False)
-    session: Session = field(init=False)
+    session: Optional[aiohttp.ClientSession] = field(default=None, init=False)
+    _status_cache: TTLCache = field(init=False, repr=False)
+    _search_cache: LRUCache = field(init=False, repr=False)
+    _lastfm_bucket: TokenBucket = field(init=False, repr=False)
 
     def __post_init__(self):
         self.endpoint = f"{self.hostname}:{self.port}"
-        self.session = Session()
+        self.base_url = f"https://{self.endpoint}/"
+        self._status_cache = TTLCache(maxsize=4, ttl=2.0)
+        self._search_cache = LRUCache(maxsize=1024)
+        # Last.fm allows about 5 requests per second per API key
+        self._lastfm_bucket = TokenBucket(rate=4, capacity=4)
+
+    async def connect(self):
+        """Open the HTTP session and log in, done on entering `async with`.
+
+        Cookies saved by a previous run are tried first, login only happens
+        when DSM rejects them. API versions and the player id are reused for
+        a day.
+        """
+        # DSM is often reached by IP address, whose cookies aiohttp drops by default
+        cookie_jar = aiohttp.CookieJar(unsafe=True)
+        try:
+            cookie_jar.load(COOKIES_PATH)
+        except (OSError, EOFError, pickle.PickleError):
+            logging.debug("No saved cookies in %s", COOKIES_PATH)
+
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                ssl=self.verify, limit=20, keepalive_timeout=75
+            ),
+            cookie_jar=cookie_jar,
+            timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT),
+        )
 
-        response = self.query_syno_api_info()
+        if endpoint := ENDPOINTS.get(self._endpoint_key):
+            self.versions = endpoint["versions"]
+            self.set_player_id(endpoint["player_id"])
+            try:
+                # Also warms the status cache for the first poll
+                await self.get_remote_player_status(force=True)
+            except RemotePlayerError:
+                await self.relogin()
+            return
+
+        response = await self.query_syno_api_info()
         self.versions = {k: v for k, v in response["data"].items() if "Audio" in k}
 
-        self.login()
-        self.get_remote_player_id()
+        try:
+            await self.get_remote_player_id()
+        except SessionError:
+            await self.login()
+            await self.get_remote_player_id()
+        self.save_endpoint()
+
+    @property
+    def _endpoint_key(self) -> tuple[str, str]:
+        return self.hostname, REMOTE_PLAYER_NAME
+
+    def save_endpoint(self):
+        ENDPOINTS.set(self._endpoint_key, versions=self.versions, player_id=self.player_id)
 
-    def request(
-        self, verb: Literal["post", "get"], path: str, data: Optional[str] = None
-    ) -> Any:
-        full_path = f"https://{self.endpoint}/{path}"
+    async def close(self):
+        # connect() may have failed before the session was opened
+        if self.session is not None:
+            await self.session.close()
+
+    async def __aenter__(self) -> AudioStationRemote:
+        try:
+            await self.connect()
+        except BaseException:
+            await self.close()
+            raise
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def relogin(self):
+        """Refresh the session cookies, keeping the pooled connections.
+
+        The player id is looked up again too, the cached one may be stale.
+        """
+        logging.info("Logging in again to %s", self.endpoint)
+        self._status_cache.clear()
+        await self.login()
+        await self.get_remote_player_id()
+        self.save_endpoint()
+
+    async def request(
+        self, verb: Literal["post", "get"], path: str, data: Optional[bytes] = None
+    ) -> dict[str, Any]:
+        """Send a request to DSM and return the decoded JSON answer."""
+        full_path = self.base_url + path
         logging.debug("Requesting %s", full_path)
         logging.debug("Data: %s", data)
 
-        request = self.session.request(
-            verb, full_path, data=data.encode() if data is not None else None, verify=self.verify
-        )
-        if error_message := request.json().get("error"):
+        async with self.session.request(
+            verb,
+            full_path,
+            data=data,
+            headers=FORM_HEADERS if data is not None else None,
+        ) as response:
+            response.raise_for_status()
+            body = await response.read()
+
+        try:
+            payload = orjson.loads(body)
+        except orjson.JSONDecodeError as e:
+            raise RemotePlayerError(f"Invalid JSON answer from {full_path}: {body[:100]!r}") from e
+
+        if error_message := payload.get("error"):
+            if error_message.get("code") in SESSION_ERROR_CODES:
+                raise SessionError(error_message)
             raise RemotePlayerError(error_message)
         else:
-            return request
+            return payload
 
-    def __del__(self):
-        self.session.close()
-
-    def query_syno_api_info(self):
-        return self.request(
+    async def query_syno_api_info(self):
+        return await self.request(
             "get", "webapi/entry.cgi?api=SYNO.API.Info&version=1&method=query"
-        ).json()
+        )
 
-    def login(self):
-        """Set cookies."""
-        return self.request(
+    async def login(self):
+        """Set cookies and save them for the next run."""
+        response = await self.request(
             "get",
             f'webapi/entry.cgi?api=SYNO.API.Auth&version=6&method=login&account={self.account}&passwd={self.password}&session=AudioStation&format=cookie',
-        ).json()
+        )
+        self.save_cookies()
+        return response
+
+    def save_cookies(self):
+        COOKIES_PATH.parent.mkdir(parents=True, exist_ok=True)
+        # The session id is as good as the password, keep it private
+        COOKIES_PATH.touch(mode=0o600)
+        self.session.cookie_jar.save(COOKIES_PATH)
 
-    def list_remote_players(self):
-        return self.request(
+    async def list_remote_players(self):
+        return await self.request(
             "post",
             f"webapi/AudioStation/remote_player.cgi",
-            data="api=SYNO.AudioStation.RemotePlayer&version=3&method=list",
-        ).json()
-
-    def get_remote_player_id(self):
-        self.player_id = next(
-            x["id"]
-            for x in self.list_remote_players()["data"]["players"]
-            if x["name"] == REMOTE_PLAYER_NAME
+            data=LIST_PLAYERS_BODY,
         )
+
+    async def get_remote_player_id(self):
+        players = {
+            x["name"]: x["id"]
+            for x in (await self.list_remote_players())["data"]["players"]
+        }
+        self._players = players
+        try:
+            self.set_player_id(players[REMOTE_PLAYER_NAME])
+        except KeyError:
+            raise RemotePlayerError(
+                f"player {REMOTE_PLAYER_NAME!r} not among {list(players)}"
+            ) from None
         return self.player_id
 
-    def get_remote_player_status(self) -> RemotePlayerStatus:
-        return (
-            self.request(
-                "post",
-                f"webapi/AudioStation/remote_player.cgi",
-                data=f"api=SYNO.AudioStation.RemotePlayerStatus&version=1&method=getstatus&id={self.player_id}&additional=song_tag",
-            )
-            .json()
-            .get("data", {})
+    def set_player_id(self, player_id: str):
+        self.player_id = player_id
+        self._status_body = PLAYER_STATUS_BODY % player_id.encode()
+
+    async def get_remote_player_status(self, force: bool = False) -> RemotePlayerStatus:
+        """Status of the remote player, reused for a couple of seconds unless forced."""
+        if not force and (status := self._status_cache.get(self.player_id)) is not None:
+            return status
+
+        response = await self.request(
+            "post",
+            f"webapi/AudioStation/remote_player.cgi",
+            data=self._status_body,
         )
+        status = response.get("data", {})
+        self._status_cache[self.player_id] = status
+        return status
 
-    def get_now_playing(self) -> Optional[NowPlaying]:
-        info = self.get_remote_player_status()
+    async def get_now_playing(self) -> Optional[NowPlaying]:
+        info = await self.get_remote_player_status()
         if info["state"] != "playing":
             return None
 
         song = info["song"]["additional"].get("song_tag")
         if not song:
-            raise RemotePlayerError("No info found")
+            # Radio streams and the like have no tags, nothing to scrobble
+            logging.debug("No song tags for %s", info["song"].get("title"))
+            return None
         return cast(NowPlaying, {"title": info["song"]["title"], **song})
 
-    def search_for_artist(self, artist: str) -> dict[str, Any]:
+    async def search_for_artist(self, artist: str) -> dict[str, Any]:
+        """Library search, remembered for the whole run."""
+        if (result := self._search_cache.get(artist)) is not None:
+            return result
+
+        result = await self._search_for_artist_raw(artist)
+        if result:
+            self._search_cache[artist] = result
+        return result
+
+    async def _search_for_artist_raw(self, artist: str) -> dict[str, Any]:
         logging.debug("Searching for artist %s", artist)
+        response = await self.request(
+            "post",
+            "webapi/AudioStation/artist.cgi",
+            data=SEARCH_ARTIST_BODY % quote_plus(artist).encode(),
+        )
+        return response.get("data", {})
+
+    async def get_lastfm_similar(self, artist: str, limit: int = 30) -> list[str]:
+        """Cached and rate limited get_similar."""
+        if (similar := SIMILAR_ARTISTS.get(artist)) is not None:
+            return similar[:limit]
+
+        await self._lastfm_bucket.acquire()
         try:
-            return (
-                self.request(
-                    "post",
-                    "webapi/AudioStation/artist.cgi",
-                    data=f"api=SYNO.AudioStation.Artist&version=4&method=list&filter={artist}&library=all&limit=10&offset=0&additional=avg_rating",
+            similar = await run_lastfm(get_similar, self.last_fm_network, artist, limit)
+        except pylast.WSError:
+            logging.warning("Last.fm rate limit exceeded, retrying in %ss", RATE_LIMIT_DELAY)
+            await asyncio.sleep(RATE_LIMIT_DELAY)
+            await self._lastfm_bucket.acquire()
+            try:
+                similar = await run_lastfm(
+                    get_similar, self.last_fm_network, artist, limit
                 )
-                .json()
-                .get("data", {})
-            )
-        except UnicodeEncodeError:
-            return {}
+            except pylast.WSError:
+                logging.warning("Still rate limited, skipping %s", artist)
+                return []
 
-    def get_similar_artists(self, artist: str, limit: int = 30) -> set[str]:
+        if similar:
+            SIMILAR_ARTISTS.set(artist, similar)
+        return similar
+
+    async def get_similar_artists(self, artist: str, limit: int = 30) -> set[str]:
         if not self.last_fm_network:
             return set()
 
-        if similar_artists_set := SIMILAR_ARTISTS.get(artist, set()):
-            return similar_artists_set
-
-        similar_artists = get_similar(self.last_fm_network, artist, limit)
+        similar_artists_set: set[str] = set()
+        similar_artists = await self.get_lastfm_similar(artist, limit)
 
+        queue: asyncio.Queue[str] = asyncio.Queue()
         for artist_ in similar_artists:
-            for similar_artist in self.search_for_artist(artist_).get("artists", []):
-                if set(artist_.replace(",", " ").split(" ")) & set(
-                    similar_artist["name"].replace(",", " ").split(" ")
-                ):
-                    similar_artists_set.add(similar_artist["name"])
+            queue.put_nowait(artist_)
+        results: dict[str, dict[str, Any]] = {}
 
-        SIMILAR_ARTISTS[artist] = similar_artists_set
+        async def worker():
+            while not queue.empty():
+                name = queue.get_nowait()
+                results[name] = await self.search_for_artist(name)
+
+        # A few workers draining the queue keep DSM below its connection limit
+        workers = [asyncio.create_task(worker()) for _ in range(SEARCH_WORKERS)]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            # On failure, stop the other workers and collect their outcome
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+        for artist_, result in results.items():
+            a_tokens = _tokens(artist_)
+            candidates = [(x["name"], _tokens(x["name"])) for x in result.get("artists", [])]
+            for name, c_tokens in candidates:
+                if not a_tokens.isdisjoint(c_tokens):
+                    similar_artists_set.add(name)
 
         return similar_artists_set
 
 
+_NETWORK: Optional[pylast.LastFMNetwork] = None
+
+
+def get_network() -> pylast.LastFMNetwork:
+    """Shared Last.fm client, created (and the password hashed) on first use."""
+    global _NETWORK
+    if _NETWORK is None:
+        _NETWORK = pylast.LastFMNetwork(
+            api_key=os.getenv("API_KEY"),
+            api_secret=os.getenv("API_SECRET"),
+            username=os.getenv("SCROBBLE_USERNAME"),
+            password_hash=pylast.md5(os.getenv("SCROBBLE_PASSWORD")),
+        )
+    return _NETWORK
+
+
 def setup():
-    network = pylast.LastFMNetwork(
-        api_key=os.getenv("API_KEY"),
-        api_secret=os.getenv("API_SECRET"),
-        username=os.getenv("SCROBBLE_USERNAME"),
-        password_hash=pylast.md5(os.getenv("SCROBBLE_PASSWORD")),
-    )
+    network = get_network()
 
     remote = AudioStationRemote(
         DSM_HOSTNAME,
@@ -243,51 +469,73 @@ def setup():
     return network, remote
 
 
-def main():
+async def run():
     logging.basicConfig(level=logging.INFO)
 
-    network: pylast.LastFMNetwork = None
-    remote: AudioStationRemote = None
-    current_track: dict = {}
-
-    while True:
-        if not (network or remote):
-            network, remote = setup()
-
-        try:
-            info = remote.get_now_playing()
-            if info and current_track != info:
-                logging.info(
-                    f"Now playing {info['title']} from artist {info['artist']} in album {info['album']}"
-                )
-                network.update_now_playing(
-                    info["artist"],
-                    info["title"],
-                    info["album"],
-                    info["album_artist"],
-                    track_number=info["track"],
-                )
-
-                network.scrobble(
-                    artist=info["artist"],
-                    timestamp=time.time(),
-                    title=info["title"],
-                    album=info["album"],
-                    album_artist=info["album_artist"],
-                    track_number=info["track"],
-                )
-                current_track = copy.copy(info)
-
-                similar_artists = remote.get_similar_artists(info["artist"])
-                if similar_artists:
-                    logging.info(f"Similar to {', '.join(similar_artists)}")
+    network, remote = setup()
+    current_key: tuple = ()
+    needs_login = False
+    unchanged_count = 0
+
+    async with remote:
+        while True:
+            try:
+                if needs_login:
+                    await remote.relogin()
+                    needs_login = False
+
+                info = await remote.get_now_playing()
+                if not info:
+                    delay = IDLE_POLL_INTERVAL
+                elif (new_key := _track_key(info)) == current_key:
+                    # Back off while the same song keeps playing
+                    unchanged_count = min(unchanged_count + 1, 6)
+                    delay = min(MAX_POLL_INTERVAL, 2**unchanged_count)
                 else:
-                    logging.info("Nothing similar")
-        except pylast.NetworkError:
-            logging.info("Reconnect")
-            time.sleep(10)
-
-        time.sleep(5)
+                    unchanged_count = 0
+                    delay = 1
+                    logging.info(
+                        f"Now playing {info['title']} from artist {info['artist']} in album {info['album']}"
+                    )
+                    await run_lastfm(
+                        network.update_now_playing,
+                        info["artist"],
+                        info["title"],
+                        info["album"],
+                        info["album_artist"],
+                        track_number=info["track"],
+                    )
+
+                    await run_lastfm(
+                        network.scrobble,
+                        artist=info["artist"],
+                        timestamp=time.time(),
+                        title=info["title"],
+                        album=info["album"],
+                        album_artist=info["album_artist"],
+                        track_number=info["track"],
+                    )
+                    current_key = new_key
+
+                    similar_artists = await remote.get_similar_artists(info["artist"])
+                    if similar_artists:
+                        logging.info(f"Similar to {', '.join(similar_artists)}")
+                    else:
+                        logging.info("Nothing similar")
+            except (
+                pylast.NetworkError,
+                SessionError,
+                aiohttp.ClientError,
+                asyncio.TimeoutError,
+            ):
+                logging.info("Reconnect")
+                needs_login = True
+                delay = RECONNECT_DELAY
+            except RemotePlayerError as e:
+                logging.warning("Remote player error: %s", e)
+                delay = RECONNECT_DELAY
+
+            await asyncio.sleep(delay)
 
     return
 
@@ -321,6 +569,11 @@ To stop the stream:
 wget -qO - --load-cookies cookies.txt --post-data "api=SYNO.AudioStation.RemotePlayer&method=control&action=stop&id=[homepod]&version=3" https://[fqdn]:5001/webapi/AudioStation/remote_player.cgi
 """
 
+
+def main():
+    asyncio.run(run())
+
+
 if __name__ == "__main__":
     main()
 